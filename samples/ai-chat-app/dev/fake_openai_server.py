@@ -0,0 +1,213 @@
+"""Local fake Azure OpenAI server for developing and load testing the AI Chat App.
+
+Serves the chat completions endpoint (plain and streamed) with canned replies
+and can simulate throttling, server errors and latency, so the client layer's
+retries, rate limiting and connection reuse can be exercised without an
+Azure OpenAI resource.
+
+Usage:
+    python dev/fake_openai_server.py --port 8089 --rpm 30 --fail-rate 0.1
+
+    set AZURE_OPENAI_ENDPOINT=http://localhost:8089/
+    set AZURE_OPENAI_API_KEY=fake
+    set AZURE_OPENAI_DEPLOYMENT_NAME=gpt-35-turbo
+    python src/app.py
+
+GET /stats returns counters of what the server has seen.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETIONS_PATH = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/chat/completions')
+
+
+class FakeOpenAIState:
+    """Counters and the sliding request window shared by all handler threads"""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.connections = 0
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    def admit(self):
+        """Return the seconds the caller must wait if over the rate limit, else None"""
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > self.args.window:
+                self.recent.popleft()
+            if self.args.rpm and len(self.recent) >= self.args.rpm:
+                self.throttled += 1
+                return self.args.window - (now - self.recent[0])
+            self.recent.append(now)
+            return None
+
+    def should_fail(self):
+        """Whether to answer the current request with a simulated server error"""
+        with self.lock:
+            if self.failed < self.args.fail_first or random.random() < self.args.fail_rate:
+                self.failed += 1
+                return True
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'failed': self.failed,
+                'connections': self.connections,
+                'max_concurrent': self.max_concurrent
+            }
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def log_message(self, format, *args):
+            if not state.args.quiet:
+                super().log_message(format, *args)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, state.stats())
+            else:
+                self.send_json(404, {'error': {'message': 'Not found'}})
+
+        def do_POST(self):
+            match = COMPLETIONS_PATH.match(self.path)
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not match:
+                self.send_json(404, {'error': {'code': 'DeploymentNotFound', 'message': 'Not found'}})
+                return
+            if not self.headers.get('api-key'):
+                self.send_json(401, {'error': {'code': '401', 'message': 'Access denied due to invalid key'}})
+                return
+
+            retry_after = state.admit()
+            if retry_after is not None:
+                self.send_json(429, {'error': {'code': '429', 'message': 'Requests have exceeded the rate limit'}},
+                               headers={'Retry-After': str(int(retry_after) + 1),
+                                        'retry-after-ms': str(int(retry_after * 1000))})
+                return
+
+            if state.should_fail():
+                self.send_json(503, {'error': {'code': '503', 'message': 'Service temporarily unavailable'}})
+                return
+
+            with state.lock:
+                state.concurrent += 1
+                state.max_concurrent = max(state.max_concurrent, state.concurrent)
+            try:
+                time.sleep(state.args.latency)
+                self.reply(match.group('deployment'), body)
+            finally:
+                with state.lock:
+                    state.concurrent -= 1
+
+        def reply(self, deployment, body):
+            messages = body.get('messages', [])
+            last_user = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+            content = f"This is a fake reply from {deployment}. You said: {last_user}"
+            prompt_tokens = sum(count_tokens(m.get('content', '')) + 3 for m in messages) + 3
+            completion_tokens = count_tokens(content)
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+            if not body.get('stream'):
+                self.send_json(200, {
+                    'id': completion_id,
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': deployment,
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                              'total_tokens': prompt_tokens + completion_tokens}
+                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for word in re.findall(r'\S+\s*', content):
+                time.sleep(state.args.token_delay)
+                self.send_chunk(completion_id, deployment, {'content': word})
+            self.send_chunk(completion_id, deployment, {}, finish_reason='stop')
+            self.write_chunk(b'data: [DONE]\n\n')
+            self.write_chunk(b'')
+
+        def send_chunk(self, completion_id, deployment, delta, finish_reason=None):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': deployment,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+
+        def send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Azure OpenAI chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per window before answering 429 (0: unlimited)')
+    parser.add_argument('--window', type=float, default=60.0,
+                        help='Length in seconds of the window --rpm is counted over (shorten it to speed up tests)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of requests answered with 503')
+    parser.add_argument('--fail-first', type=int, default=0, help='Answer the first N requests with 503')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before a response starts')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Seconds between streamed chunks')
+    parser.add_argument('--quiet', action='store_true', help='Do not log every request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(FakeOpenAIState(args)))
+    print(f"Fake Azure OpenAI listening on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,143 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
 import openai
 import os
 import logging
+import time
 from datetime import datetime
 import uuid
+from completion_cache import cache_key, create_cache_from_env
+from conversation_store import create_store_from_env
+from openai_client import create_client_from_env
+from usage_metrics import create_metrics_from_env
+from token_budget import TOKENS_PER_MESSAGE, with_token_count
+from chat_core import (
+    COMPLETION_PARAMS, CONVERSATION_TOKEN_QUOTA, DEPLOYMENT_NAME, HISTORY_TOKEN_BUDGET, MODEL_NAME,
+    STORED_HISTORY_TOKENS, SUMMARIZE_HISTORY, SUMMARY_MAX_TOKENS, assemble_messages, assistant_entry,
+    check_openai_config, demo_response, fallback_start, plan_history, quota_error, sse_event, summary_entry,
+    summary_request, summary_request_tokens
+)
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
 logging.basicConfig(level=logging.INFO)
 
-# Azure OpenAI configuration
-openai.api_type = "azure"
-openai.api_base = os.environ.get("AZURE_OPENAI_ENDPOINT", "")
-openai.api_key = os.environ.get("AZURE_OPENAI_API_KEY", "")
-openai.api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-06-01")
+# The session cookie only carries the conversation id. Set FLASK_SECRET_KEY so that
+# sessions survive restarts and are accepted by every gunicorn worker.
+app.secret_key = os.environ.get('FLASK_SECRET_KEY') or os.urandom(24)
+if not os.environ.get('FLASK_SECRET_KEY'):
+    app.logger.warning("FLASK_SECRET_KEY not set; sessions will not survive restarts or be shared between workers")
 
-DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo")
-MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo")
+# Azure OpenAI client: connection pooling, retries, rate limiting and concurrency control
+openai_client = create_client_from_env()
 
-def check_openai_config():
-    """Check if OpenAI configuration is available"""
-    required_vars = ["AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "AZURE_OPENAI_DEPLOYMENT_NAME"]
-    missing_vars = [var for var in required_vars if not os.environ.get(var)]
-    return len(missing_vars) == 0, missing_vars
+# Server-side conversation history, keyed by the conversation id in the session
+conversation_store = create_store_from_env(max_history_tokens=STORED_HISTORY_TOKENS)
+
+# Cache of completions for identical requests (e.g. common first questions)
+completion_cache = create_cache_from_env()
+
+# Token usage and latency accounting, per deployment and per conversation
+usage_metrics = create_metrics_from_env()
+
+def get_conversation_id():
+    """Return the conversation id from the session, starting a new conversation if needed"""
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+    return session['conversation_id']
+
+def check_conversation_quota(conversation_id):
+    """Return an error response if the conversation has used up its token quota"""
+    if not CONVERSATION_TOKEN_QUOTA:
+        return None
+    used = conversation_store.tokens_used(conversation_id)
+    error = quota_error(conversation_id, used)
+    if not error:
+        return None
+    app.logger.warning(f"Conversation {conversation_id} exceeded its token quota ({used}/{CONVERSATION_TOKEN_QUOTA})")
+    return jsonify(error), 429
+
+def record_usage(conversation_id, prompt_tokens, completion_tokens, latency_ms, time_to_first_token_ms=None, queue_ms=None):
+    """Record a completion in the metrics and against the conversation's token quota"""
+    usage_metrics.record_completion(
+        DEPLOYMENT_NAME, conversation_id, prompt_tokens, completion_tokens, latency_ms, time_to_first_token_ms, queue_ms
+    )
+    if CONVERSATION_TOKEN_QUOTA:
+        conversation_store.add_tokens(conversation_id, prompt_tokens + completion_tokens)
+
+def create_completion(messages, prompt_tokens, conversation_id):
+    """Call Azure OpenAI and reduce the response to what we cache and return"""
+    # Latency is timed from when the request was sent; rate limit and retry waits are queue time
+    timings = {}
+    started = time.perf_counter()
+    try:
+        response = openai_client.chat_completion(
+            messages,
+            estimated_tokens=prompt_tokens + COMPLETION_PARAMS['max_tokens'],
+            timings=timings,
+            **COMPLETION_PARAMS
+        )
+    except openai.error.OpenAIError:
+        usage_metrics.record_error(DEPLOYMENT_NAME)
+        raise
+    sent_at = timings.get('sent_at', started)
+    record_usage(
+        conversation_id,
+        response.usage.prompt_tokens, response.usage.completion_tokens,
+        (time.perf_counter() - sent_at) * 1000, queue_ms=(sent_at - started) * 1000
+    )
+    # Count the reply's tokens once, so cache hits can store it without recounting
+    entry = assistant_entry(response.choices[0].message.content.strip())
+    return {
+        'content': entry['content'],
+        'tokens': entry['tokens'],
+        'usage': {
+            'prompt_tokens': response.usage.prompt_tokens,
+            'completion_tokens': response.usage.completion_tokens,
+            'total_tokens': response.usage.total_tokens
+        }
+    }
+
+def summarize_history(conversation_id, summary, messages, covered):
+    """Fold messages into the running summary of a conversation and store it"""
+    summary_messages = summary_request(summary, messages)
+    timings = {}
+    started = time.perf_counter()
+    try:
+        response = openai_client.chat_completion(
+            summary_messages,
+            estimated_tokens=summary_request_tokens(summary, messages) + SUMMARY_MAX_TOKENS,
+            timings=timings,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        )
+    except openai.error.OpenAIError:
+        usage_metrics.record_error(DEPLOYMENT_NAME)
+        raise
+    sent_at = timings.get('sent_at', started)
+    record_usage(
+        conversation_id,
+        response.usage.prompt_tokens, response.usage.completion_tokens,
+        (time.perf_counter() - sent_at) * 1000, queue_ms=(sent_at - started) * 1000
+    )
+    
+    summary = summary_entry(response.choices[0].message.content, covered)
+    conversation_store.append(conversation_id, summary)
+    return summary
+
+def build_messages(conversation_id, conversation_history, user_entry):
+    """Prepare messages for OpenAI: system message, optional summary and the history that fits the token budget
+    
+    Returns the messages and their prompt token count.
+    """
+    summary, history, start, summarize_from = plan_history(conversation_history, user_entry)
+    
+    if summarize_from is not None:
+        try:
+            summary = summarize_history(conversation_id, summary, history[summarize_from:start], start)
+        except openai.error.OpenAIError as e:
+            app.logger.error(f"Failed to summarize history, dropping older turns instead: {str(e)}")
+            summary, start = None, fallback_start(history)
+    
+    return assemble_messages(summary, history, start)
 
 @app.route('/')
 def home():
@@ -48,65 +163,39 @@ def chat():
                 'demo_mode': True
             }), 200
         
-        # Get conversation history from session
-        if 'conversation_id' not in session:
-            session['conversation_id'] = str(uuid.uuid4())
-        
-        conversation_history = session.get('messages', [])
-        
-        # Add user message to history
-        conversation_history.append({
-            "role": "user",
-            "content": user_message
-        })
+        # Get conversation history from the conversation store
+        conversation_id = get_conversation_id()
+        quota_response = check_conversation_quota(conversation_id)
+        if quota_response:
+            return quota_response
         
-        # Prepare messages for OpenAI (include system message)
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a helpful AI assistant running on Azure OpenAI Service. 
-                You are knowledgeable, friendly, and concise in your responses. 
-                Feel free to help with various topics including technology, programming, general questions, and more.
-                If asked about yourself, mention that you're powered by Azure OpenAI Service."""
-            }
-        ]
+        conversation_history = conversation_store.get(conversation_id)
         
-        # Add conversation history (keep last 10 messages to manage token limits)
-        messages.extend(conversation_history[-10:])
+        user_entry = with_token_count({"role": "user", "content": user_message}, MODEL_NAME)
+        messages, prompt_tokens = build_messages(conversation_id, conversation_history, user_entry)
         
         try:
-            # Call Azure OpenAI
-            response = openai.ChatCompletion.create(
-                engine=DEPLOYMENT_NAME,
-                messages=messages,
-                max_tokens=500,
-                temperature=0.7,
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.1
-            )
+            # Call Azure OpenAI, unless an identical request is cached or already in flight
+            key = cache_key(DEPLOYMENT_NAME, COMPLETION_PARAMS, messages)
+            result, cached = completion_cache.get_or_compute(key, lambda: create_completion(messages, prompt_tokens, conversation_id))
+            if cached:
+                usage_metrics.record_cache_hit(DEPLOYMENT_NAME)
             
-            assistant_message = response.choices[0].message.content.strip()
-            
-            # Add assistant response to history
-            conversation_history.append({
-                "role": "assistant",
-                "content": assistant_message
-            })
+            assistant_message = result['content']
             
-            # Update session
-            session['messages'] = conversation_history
+            # Add the exchange to history
+            conversation_store.append(
+                conversation_id,
+                user_entry,
+                assistant_entry(assistant_message, result.get('tokens'))
+            )
             
             return jsonify({
                 'response': assistant_message,
-                'conversation_id': session['conversation_id'],
+                'conversation_id': conversation_id,
                 'timestamp': datetime.now().isoformat(),
                 'model': MODEL_NAME,
-                'usage': {
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'completion_tokens': response.usage.completion_tokens,
-                    'total_tokens': response.usage.total_tokens
-                }
+                'usage': dict(result['usage'], cached=cached)
             })
             
         except openai.error.OpenAIError as e:
@@ -128,9 +217,9 @@ def chat():
         app.logger.error(f"Error in chat endpoint: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
-@app.route('/api/chat/demo', methods=['POST'])
-def demo_chat():
-    """Demo mode when OpenAI is not configured"""
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the assistant reply token by token as Server-Sent Events"""
     try:
         data = request.get_json()
         if not data or 'message' not in data:
@@ -140,26 +229,140 @@ def demo_chat():
         if not user_message:
             return jsonify({'error': 'Message cannot be empty'}), 400
         
-        # Simple demo responses
-        demo_responses = {
-            'hello': "Hello! I'm a demo AI assistant. In a real deployment, I would be powered by Azure OpenAI Service.",
-            'how are you': "I'm doing well, thank you! This is a demo response since OpenAI service is not configured.",
-            'what can you do': "In demo mode, I can only provide simple responses. When properly configured with Azure OpenAI, I can help with complex questions, coding, writing, and much more!",
-            'azure': "Azure is Microsoft's cloud computing platform! It offers many AI services including Azure OpenAI Service which powers advanced chat applications like this one.",
-            'default': f"Thanks for your message: '{user_message}'. This is a demo response. To get real AI responses, please configure the Azure OpenAI Service environment variables."
-        }
+        # Check OpenAI configuration
+        config_ok, missing_vars = check_openai_config()
+        if not config_ok:
+            return jsonify({
+                'error': 'OpenAI service not configured',
+                'details': f'Missing environment variables: {", ".join(missing_vars)}',
+                'demo_mode': True
+            }), 200
+        
+        conversation_id = get_conversation_id()
+        quota_response = check_conversation_quota(conversation_id)
+        if quota_response:
+            return quota_response
+        
+        conversation_history = conversation_store.get(conversation_id)
+        user_entry = with_token_count({"role": "user", "content": user_message}, MODEL_NAME)
+        messages, prompt_tokens = build_messages(conversation_id, conversation_history, user_entry)
         
-        # Simple keyword matching for demo
-        response_key = 'default'
-        user_lower = user_message.lower()
+        key = cache_key(DEPLOYMENT_NAME, COMPLETION_PARAMS, messages)
+        
+        def generate():
+            try:
+                cached = completion_cache.get(key)
+                if cached is not None:
+                    # Cache hits are sent as a single delta
+                    assistant_message = cached['content']
+                    reply_entry = assistant_entry(assistant_message, cached.get('tokens'))
+                    yield sse_event({'delta': assistant_message})
+                    usage = dict(cached['usage'], cached=True)
+                    usage_metrics.record_cache_hit(DEPLOYMENT_NAME)
+                else:
+                    # Streams are cached once complete but not coalesced while in flight
+                    chunks = []
+                    time_to_first_token_ms = None
+                    timings = {}
+                    started = time.perf_counter()
+                    response = openai_client.chat_completion(
+                        messages,
+                        estimated_tokens=prompt_tokens + COMPLETION_PARAMS['max_tokens'],
+                        stream=True,
+                        timings=timings,
+                        **COMPLETION_PARAMS
+                    )
+                    sent_at = timings.get('sent_at', started)
+                    
+                    try:
+                        for chunk in response:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.get('content')
+                            if delta:
+                                if time_to_first_token_ms is None:
+                                    time_to_first_token_ms = (time.perf_counter() - sent_at) * 1000
+                                chunks.append(delta)
+                                yield sse_event({'delta': delta})
+                    finally:
+                        # Charge what was streamed even if the client disconnected or the stream failed
+                        assistant_message = ''.join(chunks).strip()
+                        # Count the reply once: the stored entry's token count also gives the usage
+                        reply_entry = assistant_entry(assistant_message)
+                        completion_tokens = reply_entry['tokens'] - TOKENS_PER_MESSAGE
+                        record_usage(
+                            conversation_id, prompt_tokens, completion_tokens,
+                            (time.perf_counter() - sent_at) * 1000, time_to_first_token_ms,
+                            (sent_at - started) * 1000
+                        )
+                    # Streamed completions don't report usage, so count it with the tokenizer
+                    usage = {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens,
+                        'total_tokens': prompt_tokens + completion_tokens,
+                        'estimated': True
+                    }
+                    completion_cache.set(key, {'content': assistant_message, 'tokens': reply_entry['tokens'], 'usage': usage})
+                    usage = dict(usage, cached=False)
+                
+                # Add the finished exchange to history
+                conversation_store.append(
+                    conversation_id,
+                    user_entry,
+                    reply_entry
+                )
+                
+                yield sse_event({
+                    'response': assistant_message,
+                    'conversation_id': conversation_id,
+                    'timestamp': datetime.now().isoformat(),
+                    'model': MODEL_NAME,
+                    'usage': usage
+                }, event='done')
+                
+            except openai.error.OpenAIError as e:
+                app.logger.error(f"OpenAI API error: {str(e)}")
+                usage_metrics.record_error(DEPLOYMENT_NAME)
+                yield sse_event({
+                    'error': 'AI service error',
+                    'details': str(e),
+                    'demo_mode': True
+                }, event='error')
+            except Exception as e:
+                app.logger.error(f"Unexpected error in OpenAI stream: {str(e)}")
+                yield sse_event({
+                    'error': 'AI service unavailable',
+                    'details': 'Please check your OpenAI configuration',
+                    'demo_mode': True
+                }, event='error')
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+        
+    except Exception as e:
+        app.logger.error(f"Error in chat stream endpoint: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/chat/demo', methods=['POST'])
+def demo_chat():
+    """Demo mode when OpenAI is not configured"""
+    try:
+        data = request.get_json()
+        if not data or 'message' not in data:
+            return jsonify({'error': 'Message is required'}), 400
         
-        for key in demo_responses:
-            if key in user_lower:
-                response_key = key
-                break
+        user_message = data['message'].strip()
+        if not user_message:
+            return jsonify({'error': 'Message cannot be empty'}), 400
         
         return jsonify({
-            'response': demo_responses[response_key],
+            'response': demo_response(user_message),
             'demo_mode': True,
             'timestamp': datetime.now().isoformat(),
             'model': 'demo-mode'
@@ -173,8 +376,9 @@ def demo_chat():
 def clear_conversation():
     """Clear the conversation history"""
     try:
-        session.pop('messages', None)
-        session.pop('conversation_id', None)
+        conversation_id = session.pop('conversation_id', None)
+        if conversation_id:
+            conversation_store.clear(conversation_id)
         return jsonify({'success': True, 'message': 'Conversation cleared'})
     except Exception as e:
         app.logger.error(f"Error clearing conversation: {str(e)}")
@@ -192,8 +396,16 @@ def status():
             'endpoint': os.environ.get("AZURE_OPENAI_ENDPOINT", "Not configured"),
             'deployment': DEPLOYMENT_NAME,
             'model': MODEL_NAME,
-            'api_version': openai.api_version,
+            'api_version': openai_client.api_version,
             'demo_mode': not config_ok,
+            'history_token_budget': HISTORY_TOKEN_BUDGET,
+            'summarize_history': SUMMARIZE_HISTORY,
+            'conversation_store': conversation_store.stats(),
+            'completion_cache': completion_cache.stats(),
+            'openai_client': openai_client.stats(),
+            'conversation_token_quota': CONVERSATION_TOKEN_QUOTA,
+            'conversation_usage': usage_metrics.conversation_summary(session.get('conversation_id')),
+            'usage': usage_metrics.summary(top_conversations=0)['deployments'],
             'timestamp': datetime.now().isoformat()
         })
         
@@ -201,6 +413,21 @@ def status():
         app.logger.error(f"Error in status endpoint: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Token usage and latency over rolling windows, per deployment and per conversation"""
+    try:
+        summary = usage_metrics.summary(top_conversations=max(0, request.args.get('top', 10, type=int)))
+        summary['conversation_token_quota'] = CONVERSATION_TOKEN_QUOTA
+        summary['completion_cache'] = completion_cache.stats()
+        summary['openai_client'] = openai_client.stats()
+        summary['timestamp'] = datetime.now().isoformat()
+        return jsonify(summary)
+        
+    except Exception as e:
+        app.logger.error(f"Error in metrics endpoint: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
@@ -0,0 +1,504 @@
+"""Async (ASGI) variant of the AI Chat App.
+
+Serves the same routes, JSON contracts and template as ``app.py``, but awaits
+Azure OpenAI on one event loop instead of holding a worker thread per request,
+so a single process can keep hundreds of chats in flight. Run it with:
+
+    uvicorn asgi_app:app
+    gunicorn -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+import openai
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.templating import Jinja2Templates
+from starlette.middleware.sessions import SessionMiddleware
+
+from chat_core import (
+    COMPLETION_PARAMS, CONVERSATION_TOKEN_QUOTA, DEPLOYMENT_NAME, HISTORY_TOKEN_BUDGET, MODEL_NAME,
+    STORED_HISTORY_TOKENS, SUMMARIZE_HISTORY, SUMMARY_MAX_TOKENS, assemble_messages, assistant_entry,
+    check_openai_config, demo_response, fallback_start, plan_history, quota_error, sse_event, summary_entry,
+    summary_request, summary_request_tokens
+)
+from completion_cache import cache_key, create_cache_from_env
+from conversation_store import create_store_from_env
+from openai_client import create_client_from_env
+from token_budget import TOKENS_PER_MESSAGE, with_token_count
+from usage_metrics import create_metrics_from_env
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="AI Chat App",
+    description="Async variant of the Azure OpenAI chat sample",
+    docs_url=None,
+    redoc_url=None
+)
+
+# The session cookie only carries the conversation id, signed with the same
+# FLASK_SECRET_KEY setting as the Flask app
+secret_key = os.environ.get('FLASK_SECRET_KEY')
+if not secret_key:
+    logger.warning("FLASK_SECRET_KEY not set; sessions will not survive restarts or be shared between workers")
+app.add_middleware(SessionMiddleware, secret_key=secret_key or os.urandom(24).hex())
+
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+openai_client = create_client_from_env()
+conversation_store = create_store_from_env(max_history_tokens=STORED_HISTORY_TOKENS)
+completion_cache = create_cache_from_env()
+usage_metrics = create_metrics_from_env()
+
+async def run_store(method, *args):
+    """Call a conversation store method, off the event loop when it hits the database"""
+    if conversation_store.backend is None:
+        return method(*args)
+    return await asyncio.to_thread(method, *args)
+
+async def read_message(request):
+    """Return (user_message, None) from the JSON body, or (None, error response)"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'message' not in data:
+        return None, JSONResponse({'error': 'Message is required'}, status_code=400)
+
+    user_message = data['message'].strip()
+    if not user_message:
+        return None, JSONResponse({'error': 'Message cannot be empty'}, status_code=400)
+    return user_message, None
+
+def not_configured_response(missing_vars):
+    return JSONResponse({
+        'error': 'OpenAI service not configured',
+        'details': f'Missing environment variables: {", ".join(missing_vars)}',
+        'demo_mode': True
+    })
+
+def get_conversation_id(request):
+    """Return the conversation id from the session, starting a new conversation if needed"""
+    if 'conversation_id' not in request.session:
+        request.session['conversation_id'] = str(uuid.uuid4())
+    return request.session['conversation_id']
+
+async def check_conversation_quota(conversation_id):
+    """Return an error response if the conversation has used up its token quota"""
+    if not CONVERSATION_TOKEN_QUOTA:
+        return None
+    used = await run_store(conversation_store.tokens_used, conversation_id)
+    error = quota_error(conversation_id, used)
+    if not error:
+        return None
+    logger.warning(f"Conversation {conversation_id} exceeded its token quota ({used}/{CONVERSATION_TOKEN_QUOTA})")
+    return JSONResponse(error, status_code=429)
+
+async def record_usage(conversation_id, prompt_tokens, completion_tokens, latency_ms, time_to_first_token_ms=None, queue_ms=None):
+    """Record a completion in the metrics and against the conversation's token quota"""
+    usage_metrics.record_completion(
+        DEPLOYMENT_NAME, conversation_id, prompt_tokens, completion_tokens, latency_ms, time_to_first_token_ms, queue_ms
+    )
+    if CONVERSATION_TOKEN_QUOTA:
+        await run_store(conversation_store.add_tokens, conversation_id, prompt_tokens + completion_tokens)
+
+async def create_completion(messages, prompt_tokens, conversation_id):
+    """Call Azure OpenAI and reduce the response to what we cache and return"""
+    # Latency is timed from when the request was sent; rate limit and retry waits are queue time
+    timings = {}
+    started = time.perf_counter()
+    try:
+        response = await openai_client.achat_completion(
+            messages,
+            estimated_tokens=prompt_tokens + COMPLETION_PARAMS['max_tokens'],
+            timings=timings,
+            **COMPLETION_PARAMS
+        )
+    except openai.error.OpenAIError:
+        usage_metrics.record_error(DEPLOYMENT_NAME)
+        raise
+    sent_at = timings.get('sent_at', started)
+    await record_usage(
+        conversation_id,
+        response.usage.prompt_tokens, response.usage.completion_tokens,
+        (time.perf_counter() - sent_at) * 1000, queue_ms=(sent_at - started) * 1000
+    )
+    # Count the reply's tokens once, so cache hits can store it without recounting
+    entry = assistant_entry(response.choices[0].message.content.strip())
+    return {
+        'content': entry['content'],
+        'tokens': entry['tokens'],
+        'usage': {
+            'prompt_tokens': response.usage.prompt_tokens,
+            'completion_tokens': response.usage.completion_tokens,
+            'total_tokens': response.usage.total_tokens
+        }
+    }
+
+async def summarize_history(conversation_id, summary, messages, covered):
+    """Fold messages into the running summary of a conversation and store it"""
+    summary_messages = summary_request(summary, messages)
+    timings = {}
+    started = time.perf_counter()
+    try:
+        response = await openai_client.achat_completion(
+            summary_messages,
+            estimated_tokens=summary_request_tokens(summary, messages) + SUMMARY_MAX_TOKENS,
+            timings=timings,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        )
+    except openai.error.OpenAIError:
+        usage_metrics.record_error(DEPLOYMENT_NAME)
+        raise
+    sent_at = timings.get('sent_at', started)
+    await record_usage(
+        conversation_id,
+        response.usage.prompt_tokens, response.usage.completion_tokens,
+        (time.perf_counter() - sent_at) * 1000, queue_ms=(sent_at - started) * 1000
+    )
+
+    summary = summary_entry(response.choices[0].message.content, covered)
+    await run_store(conversation_store.append, conversation_id, summary)
+    return summary
+
+async def build_messages(conversation_id, conversation_history, user_entry):
+    """Prepare messages for OpenAI and return them with their prompt token count"""
+    summary, history, start, summarize_from = plan_history(conversation_history, user_entry)
+
+    if summarize_from is not None:
+        try:
+            summary = await summarize_history(conversation_id, summary, history[summarize_from:start], start)
+        except openai.error.OpenAIError as e:
+            logger.error(f"Failed to summarize history, dropping older turns instead: {str(e)}")
+            summary, start = None, fallback_start(history)
+
+    return assemble_messages(summary, history, start)
+
+@app.get('/')
+async def home(request: Request):
+    return templates.TemplateResponse(request, 'index.html')
+
+@app.post('/api/chat')
+async def chat(request: Request):
+    try:
+        user_message, error_response = await read_message(request)
+        if error_response:
+            return error_response
+
+        config_ok, missing_vars = check_openai_config()
+        if not config_ok:
+            return not_configured_response(missing_vars)
+
+        conversation_id = get_conversation_id(request)
+        quota_response = await check_conversation_quota(conversation_id)
+        if quota_response:
+            return quota_response
+
+        conversation_history = await run_store(conversation_store.get, conversation_id)
+        user_entry = with_token_count({"role": "user", "content": user_message}, MODEL_NAME)
+        messages, prompt_tokens = await build_messages(conversation_id, conversation_history, user_entry)
+
+        try:
+            # Call Azure OpenAI, unless an identical request is cached or already in flight
+            key = cache_key(DEPLOYMENT_NAME, COMPLETION_PARAMS, messages)
+            result, cached = await completion_cache.aget_or_compute(
+                key, lambda: create_completion(messages, prompt_tokens, conversation_id)
+            )
+            if cached:
+                usage_metrics.record_cache_hit(DEPLOYMENT_NAME)
+
+            assistant_message = result['content']
+            await run_store(
+                conversation_store.append,
+                conversation_id,
+                user_entry,
+                assistant_entry(assistant_message, result.get('tokens'))
+            )
+
+            return JSONResponse({
+                'response': assistant_message,
+                'conversation_id': conversation_id,
+                'timestamp': datetime.now().isoformat(),
+                'model': MODEL_NAME,
+                'usage': dict(result['usage'], cached=cached)
+            })
+
+        except openai.error.OpenAIError as e:
+            logger.error(f"OpenAI API error: {str(e)}")
+            return JSONResponse({
+                'error': 'AI service error',
+                'details': str(e),
+                'demo_mode': True
+            })
+        except Exception as e:
+            logger.error(f"Unexpected error in OpenAI call: {str(e)}")
+            return JSONResponse({
+                'error': 'AI service unavailable',
+                'details': 'Please check your OpenAI configuration',
+                'demo_mode': True
+            })
+
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@app.post('/api/chat/stream')
+async def chat_stream(request: Request):
+    """Stream the assistant reply token by token as Server-Sent Events"""
+    try:
+        user_message, error_response = await read_message(request)
+        if error_response:
+            return error_response
+
+        config_ok, missing_vars = check_openai_config()
+        if not config_ok:
+            return not_configured_response(missing_vars)
+
+        conversation_id = get_conversation_id(request)
+        quota_response = await check_conversation_quota(conversation_id)
+        if quota_response:
+            return quota_response
+
+        conversation_history = await run_store(conversation_store.get, conversation_id)
+        user_entry = with_token_count({"role": "user", "content": user_message}, MODEL_NAME)
+        messages, prompt_tokens = await build_messages(conversation_id, conversation_history, user_entry)
+
+        key = cache_key(DEPLOYMENT_NAME, COMPLETION_PARAMS, messages)
+
+        async def generate():
+            try:
+                cached = completion_cache.get(key)
+                if cached is not None:
+                    # Cache hits are sent as a single delta
+                    assistant_message = cached['content']
+                    reply_entry = assistant_entry(assistant_message, cached.get('tokens'))
+                    yield sse_event({'delta': assistant_message})
+                    usage = dict(cached['usage'], cached=True)
+                    usage_metrics.record_cache_hit(DEPLOYMENT_NAME)
+                else:
+                    # Streams are cached once complete but not coalesced while in flight
+                    chunks = []
+                    time_to_first_token_ms = None
+                    timings = {}
+                    started = time.perf_counter()
+                    response = await openai_client.achat_completion(
+                        messages,
+                        estimated_tokens=prompt_tokens + COMPLETION_PARAMS['max_tokens'],
+                        stream=True,
+                        timings=timings,
+                        **COMPLETION_PARAMS
+                    )
+                    sent_at = timings.get('sent_at', started)
+
+                    try:
+                        async for chunk in response:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.get('content')
+                            if delta:
+                                if time_to_first_token_ms is None:
+                                    time_to_first_token_ms = (time.perf_counter() - sent_at) * 1000
+                                chunks.append(delta)
+                                yield sse_event({'delta': delta})
+                    finally:
+                        # Charge what was streamed even if the client disconnected or the stream failed;
+                        # shielded because a disconnect cancels every await in this generator
+                        assistant_message = ''.join(chunks).strip()
+                        # Count the reply once: the stored entry's token count also gives the usage
+                        reply_entry = assistant_entry(assistant_message)
+                        completion_tokens = reply_entry['tokens'] - TOKENS_PER_MESSAGE
+                        await asyncio.shield(record_usage(
+                            conversation_id, prompt_tokens, completion_tokens,
+                            (time.perf_counter() - sent_at) * 1000, time_to_first_token_ms,
+                            (sent_at - started) * 1000
+                        ))
+                    # Streamed completions don't report usage, so count it with the tokenizer
+                    usage = {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens,
+                        'total_tokens': prompt_tokens + completion_tokens,
+                        'estimated': True
+                    }
+                    completion_cache.set(key, {'content': assistant_message, 'tokens': reply_entry['tokens'], 'usage': usage})
+                    usage = dict(usage, cached=False)
+
+                # Add the finished exchange to history
+                await run_store(
+                    conversation_store.append,
+                    conversation_id,
+                    user_entry,
+                    reply_entry
+                )
+
+                yield sse_event({
+                    'response': assistant_message,
+                    'conversation_id': conversation_id,
+                    'timestamp': datetime.now().isoformat(),
+                    'model': MODEL_NAME,
+                    'usage': usage
+                }, event='done')
+
+            except openai.error.OpenAIError as e:
+                logger.error(f"OpenAI API error: {str(e)}")
+                usage_metrics.record_error(DEPLOYMENT_NAME)
+                yield sse_event({
+                    'error': 'AI service error',
+                    'details': str(e),
+                    'demo_mode': True
+                }, event='error')
+            except Exception as e:
+                logger.error(f"Unexpected error in OpenAI stream: {str(e)}")
+                yield sse_event({
+                    'error': 'AI service unavailable',
+                    'details': 'Please check your OpenAI configuration',
+                    'demo_mode': True
+                }, event='error')
+
+        return StreamingResponse(
+            generate(),
+            media_type='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@app.post('/api/chat/demo')
+async def demo_chat(request: Request):
+    """Demo mode when OpenAI is not configured"""
+    try:
+        user_message, error_response = await read_message(request)
+        if error_response:
+            return error_response
+
+        return JSONResponse({
+            'response': demo_response(user_message),
+            'demo_mode': True,
+            'timestamp': datetime.now().isoformat(),
+            'model': 'demo-mode'
+        })
+
+    except Exception as e:
+        logger.error(f"Error in demo chat: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@app.post('/api/chat/clear')
+async def clear_conversation(request: Request):
+    """Clear the conversation history"""
+    try:
+        conversation_id = request.session.pop('conversation_id', None)
+        if conversation_id:
+            await run_store(conversation_store.clear, conversation_id)
+        return JSONResponse({'success': True, 'message': 'Conversation cleared'})
+    except Exception as e:
+        logger.error(f"Error clearing conversation: {str(e)}")
+        return JSONResponse({'error': 'Failed to clear conversation'}, status_code=500)
+
+@app.get('/api/status')
+async def status(request: Request):
+    """Get the status of the AI service"""
+    try:
+        config_ok, missing_vars = check_openai_config()
+
+        return JSONResponse({
+            'openai_configured': config_ok,
+            'missing_variables': missing_vars if not config_ok else [],
+            'endpoint': os.environ.get("AZURE_OPENAI_ENDPOINT", "Not configured"),
+            'deployment': DEPLOYMENT_NAME,
+            'model': MODEL_NAME,
+            'api_version': openai_client.api_version,
+            'demo_mode': not config_ok,
+            'history_token_budget': HISTORY_TOKEN_BUDGET,
+            'summarize_history': SUMMARIZE_HISTORY,
+            'conversation_store': conversation_store.stats(),
+            'completion_cache': completion_cache.stats(),
+            'openai_client': openai_client.stats(),
+            'conversation_token_quota': CONVERSATION_TOKEN_QUOTA,
+            'conversation_usage': usage_metrics.conversation_summary(request.session.get('conversation_id')),
+            'usage': usage_metrics.summary(top_conversations=0)['deployments'],
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error(f"Error in status endpoint: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@app.get('/metrics')
+async def metrics(top: str = '10'):
+    """Token usage and latency over rolling windows, per deployment and per conversation"""
+    try:
+        # Parsed by hand so invalid values fall back to the default, as in the Flask app
+        try:
+            top_conversations = max(0, int(top))
+        except ValueError:
+            top_conversations = 10
+        summary = usage_metrics.summary(top_conversations=top_conversations)
+        summary['conversation_token_quota'] = CONVERSATION_TOKEN_QUOTA
+        summary['completion_cache'] = completion_cache.stats()
+        summary['openai_client'] = openai_client.stats()
+        summary['timestamp'] = datetime.now().isoformat()
+        return JSONResponse(summary)
+
+    except Exception as e:
+        logger.error(f"Error in metrics endpoint: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@app.get('/health')
+async def health():
+    """Health check endpoint"""
+    try:
+        config_ok, missing_vars = check_openai_config()
+
+        health_data = {
+            'status': 'healthy',
+            'timestamp': datetime.now().isoformat(),
+            'openai_service': 'configured' if config_ok else 'not_configured',
+            'demo_mode': not config_ok
+        }
+
+        if not config_ok:
+            health_data['missing_config'] = missing_vars
+
+        return JSONResponse(health_data)
+
+    except Exception as e:
+        logger.error(f"Health check failed: {str(e)}")
+        return JSONResponse({
+            'status': 'unhealthy',
+            'error': str(e),
+            'timestamp': datetime.now().isoformat()
+        }, status_code=503)
+
+@app.on_event("startup")
+async def startup_event():
+    logger.info(f"OpenAI Endpoint: {os.environ.get('AZURE_OPENAI_ENDPOINT', 'Not configured')}")
+    logger.info(f"Deployment: {DEPLOYMENT_NAME}")
+    logger.info(f"Model: {MODEL_NAME}")
+
+    config_ok, missing_vars = check_openai_config()
+    if not config_ok:
+        logger.warning(f"OpenAI not configured. Missing: {missing_vars}. Running in demo mode.")
+    else:
+        logger.info("OpenAI service configured successfully")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled upstream connections"""
+    await openai_client.aclose()
+
+if __name__ == '__main__':
+    import uvicorn
+    port = int(os.environ.get('PORT', 8000))
+    logger.info(f"Starting AI Chat App (ASGI) on port {port}")
+    uvicorn.run(app, host='0.0.0.0', port=port)
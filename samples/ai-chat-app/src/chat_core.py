@@ -0,0 +1,162 @@
+"""Configuration and framework-independent chat logic shared by the Flask app
+(``app.py``) and its async ASGI variant (``asgi_app.py``).
+"""
+import json
+import os
+
+from token_budget import (
+    SUMMARY_KEY, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_tokens, message_tokens, select_window,
+    split_history, strip_metadata, with_token_count
+)
+
+DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo")
+MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo")
+
+SYSTEM_PROMPT = """You are a helpful AI assistant running on Azure OpenAI Service. 
+                You are knowledgeable, friendly, and concise in your responses. 
+                Feel free to help with various topics including technology, programming, general questions, and more.
+                If asked about yourself, mention that you're powered by Azure OpenAI Service."""
+
+COMPLETION_PARAMS = {
+    'max_tokens': 500,
+    'temperature': 0.7,
+    'top_p': 0.9,
+    'frequency_penalty': 0.1,
+    'presence_penalty': 0.1
+}
+
+SYSTEM_MESSAGE = with_token_count({"role": "system", "content": SYSTEM_PROMPT}, MODEL_NAME)
+
+# History is selected by token budget rather than message count. By default it gets
+# whatever the model's context window leaves after the system prompt and the reply.
+MODEL_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_MODEL_CONTEXT_TOKENS", 4096))
+HISTORY_TOKEN_BUDGET = int(os.environ.get(
+    "HISTORY_TOKEN_BUDGET",
+    MODEL_CONTEXT_TOKENS - COMPLETION_PARAMS['max_tokens'] - TOKENS_PER_REPLY - SYSTEM_MESSAGE['tokens']
+))
+
+# Conversations store at most this many tokens of messages: enough to fill the
+# window, plus the older turns waiting to be summarized
+STORED_HISTORY_TOKENS = 2 * HISTORY_TOKEN_BUDGET
+
+# Optionally summarize turns that no longer fit the budget instead of dropping them
+SUMMARIZE_HISTORY = os.environ.get("SUMMARIZE_HISTORY", "false").lower() == "true"
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_PROMPT = """Summarize the conversation below between a user and an AI assistant.
+                Keep facts, names, decisions and open questions the assistant needs to continue the conversation.
+                Be concise."""
+SUMMARY_PROMPT_TOKENS = count_tokens(SUMMARY_PROMPT, MODEL_NAME)
+
+# Maximum tokens a single conversation may use (0 disables the check). Usage is
+# kept with the conversation in the conversation store, so workers sharing its
+# backend enforce the quota together.
+CONVERSATION_TOKEN_QUOTA = int(os.environ.get("CONVERSATION_TOKEN_QUOTA", 0))
+
+DEMO_RESPONSES = {
+    'hello': "Hello! I'm a demo AI assistant. In a real deployment, I would be powered by Azure OpenAI Service.",
+    'how are you': "I'm doing well, thank you! This is a demo response since OpenAI service is not configured.",
+    'what can you do': "In demo mode, I can only provide simple responses. When properly configured with Azure OpenAI, I can help with complex questions, coding, writing, and much more!",
+    'azure': "Azure is Microsoft's cloud computing platform! It offers many AI services including Azure OpenAI Service which powers advanced chat applications like this one.",
+}
+
+def check_openai_config():
+    """Check if OpenAI configuration is available"""
+    required_vars = ["AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "AZURE_OPENAI_DEPLOYMENT_NAME"]
+    missing_vars = [var for var in required_vars if not os.environ.get(var)]
+    return len(missing_vars) == 0, missing_vars
+
+def demo_response(user_message):
+    """Simple keyword matching for demo mode"""
+    user_lower = user_message.lower()
+    for key, response in DEMO_RESPONSES.items():
+        if key in user_lower:
+            return response
+    return f"Thanks for your message: '{user_message}'. This is a demo response. To get real AI responses, please configure the Azure OpenAI Service environment variables."
+
+def quota_error(conversation_id, used):
+    """Return the error payload if a conversation has used up its token quota, else None"""
+    if not CONVERSATION_TOKEN_QUOTA or used < CONVERSATION_TOKEN_QUOTA:
+        return None
+    return {
+        'error': 'Conversation token quota exceeded',
+        'details': f'This conversation has used {used} of {CONVERSATION_TOKEN_QUOTA} tokens. Clear the chat to start a new one.',
+        'conversation_id': conversation_id
+    }
+
+def plan_history(conversation_history, user_entry):
+    """Decide which part of the history fits the token budget
+
+    Returns (summary, history, start, summarize_from): ``history[start:]`` is sent
+    after ``summary`` (if any). When ``summarize_from`` is not None, the caller
+    must first fold ``history[summarize_from:start]`` into a new summary.
+    """
+    summary, history = split_history(conversation_history)
+    history = history + [user_entry]
+
+    start, _ = select_window(history, HISTORY_TOKEN_BUDGET, MODEL_NAME)
+    # Stored history is compacted once summarized, so an existing summary is always needed
+    if not SUMMARIZE_HISTORY or (start == 0 and summary is None):
+        return None, history, start, None
+
+    covered = summary[SUMMARY_KEY] if summary else 0
+    summary_tokens = summary['tokens'] if summary else 0
+    start, _ = select_window(history, HISTORY_TOKEN_BUDGET - summary_tokens, MODEL_NAME)
+    if start <= covered:
+        return summary, history, covered, None
+
+    # Summarize everything outside a half-budget window so the next turns fit without re-summarizing
+    start, _ = select_window(history, HISTORY_TOKEN_BUDGET // 2, MODEL_NAME)
+    return summary, history, start, covered
+
+def fallback_start(history):
+    """Start of the plain token-budget window, used when summarizing fails"""
+    return select_window(history, HISTORY_TOKEN_BUDGET, MODEL_NAME)[0]
+
+def summary_request(summary, messages):
+    """Messages asking the model to fold messages into the running summary"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if summary:
+        transcript = f"Summary so far: {summary['content']}\n\n{transcript}"
+
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ]
+
+def summary_request_tokens(summary, messages):
+    """Prompt tokens of summary_request(), estimated from the messages' stored token counts"""
+    transcript_tokens = sum(message_tokens(m, MODEL_NAME) for m in messages)
+    if summary:
+        transcript_tokens += message_tokens(summary, MODEL_NAME)
+    return TOKENS_PER_REPLY + 2 * TOKENS_PER_MESSAGE + SUMMARY_PROMPT_TOKENS + transcript_tokens
+
+def summary_entry(content, covered):
+    """Stored summary of the first ``covered`` conversation messages"""
+    return with_token_count({
+        "role": "system",
+        "content": f"Summary of the earlier conversation: {content.strip()}",
+        SUMMARY_KEY: covered
+    }, MODEL_NAME)
+
+def assistant_entry(content, tokens=None):
+    """Stored assistant message, reusing its token count if it is already known"""
+    if tokens is not None:
+        return {"role": "assistant", "content": content, "tokens": tokens}
+    return with_token_count({"role": "assistant", "content": content}, MODEL_NAME)
+
+def assemble_messages(summary, history, start):
+    """Messages for OpenAI (system message, optional summary, history window) and their prompt token count"""
+    context = ([summary] if summary else []) + history[start:]
+
+    messages = [strip_metadata(SYSTEM_MESSAGE)]
+    messages.extend(strip_metadata(m) for m in context)
+
+    prompt_tokens = TOKENS_PER_REPLY + SYSTEM_MESSAGE['tokens'] + sum(message_tokens(m, MODEL_NAME) for m in context)
+    return messages, prompt_tokens
+
+def sse_event(data, event=None):
+    """Format a Server-Sent Event"""
+    payload = f"data: {json.dumps(data)}\n\n"
+    if event:
+        payload = f"event: {event}\n" + payload
+    return payload
@@ -0,0 +1,180 @@
+"""Completion cache with in-flight request coalescing for the AI Chat App.
+
+Identical requests (same deployment, parameters and normalized messages) are
+answered from a TTL/LRU cache, and concurrent identical requests share a
+single upstream call instead of each calling OpenAI.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_whitespace = re.compile(r'\s+')
+
+
+def cache_key(deployment, params, messages):
+    """Hash the request after normalizing whitespace in the message contents"""
+    normalized = {
+        'deployment': deployment,
+        'params': params,
+        'messages': [
+            {'role': m['role'], 'content': _whitespace.sub(' ', m['content']).strip()}
+            for m in messages
+        ]
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    """An upstream call that other requests for the same key are waiting on"""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CompletionCache:
+    """LRU cache of completion results with a TTL and single-flight coalescing"""
+
+    def __init__(self, max_entries=1000, ttl_seconds=600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key):
+        """Return a cached result or None"""
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key, result):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._store(key, result)
+
+    def get_or_compute(self, key, compute):
+        """Return (result, shared): a cached or coalesced result, or the result of calling compute()
+
+        ``shared`` is True when the result did not require an upstream call of our own.
+        """
+        if not self.enabled:
+            return compute(), False
+
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None:
+                return result, True
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = compute()
+            with self._lock:
+                self._store(key, flight.result)
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    async def aget_or_compute(self, key, compute):
+        """Async version of get_or_compute, where compute() returns an awaitable
+
+        The upstream call runs as its own task, so a caller that disconnects does
+        not cancel it for the others waiting on the same key.
+        """
+        if not self.enabled:
+            return await compute(), False
+
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None:
+                return result, True
+
+            task = self._async_inflight.get(key)
+            leader = task is None
+            if leader:
+                task = self._async_inflight[key] = asyncio.ensure_future(self._compute_and_store(key, compute))
+            else:
+                self.coalesced += 1
+
+        return await asyncio.shield(task), not leader
+
+    async def _compute_and_store(self, key, compute):
+        try:
+            result = await compute()
+            with self._lock:
+                self._store(key, result)
+            return result
+        finally:
+            with self._lock:
+                self._async_inflight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'inflight': len(self._inflight) + len(self._async_inflight)
+            }
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, result = entry
+            if time.time() - stored_at <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def _store(self, key, result):
+        self._entries[key] = (time.time(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def create_cache_from_env():
+    """Build a CompletionCache configured from environment variables (TTL 0 disables caching)"""
+    return CompletionCache(
+        max_entries=int(os.environ.get('COMPLETION_CACHE_MAX_ENTRIES', 1000)),
+        ttl_seconds=int(os.environ.get('COMPLETION_CACHE_TTL_SECONDS', 600))
+    )
@@ -0,0 +1,385 @@
+"""Server-side conversation storage for the AI Chat App.
+
+Conversations are kept in process memory with LRU and TTL eviction and a
+memory budget, optionally backed by a persistent backend so that history
+survives restarts and is shared between gunicorn workers. The session
+cookie only has to carry the conversation id.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from token_budget import SUMMARY_KEY
+
+# Rough per-message overhead (dict, strings, bookkeeping) on top of the content size
+MESSAGE_OVERHEAD_BYTES = 200
+
+# Attempts at appending to a conversation that other workers keep changing
+MAX_SAVE_ATTEMPTS = 5
+
+# How often expired conversations are deleted from the backend
+PURGE_INTERVAL_SECONDS = 300
+
+
+def estimate_size(messages):
+    """Approximate the memory footprint of a list of messages in bytes"""
+    return sum(len(m.get('content', '').encode('utf-8')) + MESSAGE_OVERHEAD_BYTES for m in messages)
+
+
+def compact_history(messages, max_tokens=None):
+    """Drop stored messages that can no longer be sent to the model
+
+    Messages covered by the latest summary and older summaries are removed, the
+    summary is rebased to cover nothing, and with ``max_tokens`` the oldest
+    messages are dropped until the rest fit.
+    """
+    summary = None
+    conversation = []
+    for message in messages:
+        if SUMMARY_KEY in message:
+            summary = message
+        else:
+            conversation.append(message)
+
+    if summary is not None:
+        conversation = conversation[summary[SUMMARY_KEY]:]
+        summary = dict(summary, **{SUMMARY_KEY: 0})
+
+    if max_tokens:
+        total = sum(m.get('tokens', 0) for m in conversation)
+        start = 0
+        while total > max_tokens and start < len(conversation) - 1:
+            total -= conversation[start].get('tokens', 0)
+            start += 1
+        conversation = conversation[start:]
+
+    return ([summary] if summary else []) + conversation
+
+
+class ConversationConflict(Exception):
+    """Raised when a conversation could not be saved because other writers kept changing it"""
+
+
+class ConversationBackend:
+    """Interface for persistent conversation storage"""
+
+    def load(self, conversation_id, max_age=None):
+        """Return (messages, version) or None if the conversation is unknown or expired
+
+        Loading counts as activity: it restarts the conversation's idle timeout.
+        """
+        raise NotImplementedError
+
+    def version(self, conversation_id):
+        """Return the current version of a conversation, or None if it is unknown"""
+        raise NotImplementedError
+
+    def save(self, conversation_id, messages, expected_version):
+        """Store messages as version ``expected_version + 1`` if the stored version is still
+        ``expected_version`` (0 for a new conversation); return whether it was saved"""
+        raise NotImplementedError
+
+    def delete(self, conversation_id):
+        raise NotImplementedError
+
+    def purge(self, max_age):
+        """Delete conversations idle for longer than ``max_age`` seconds"""
+        raise NotImplementedError
+
+    def add_tokens(self, conversation_id, tokens):
+        """Add to the conversation's token total, creating the conversation if needed"""
+        raise NotImplementedError
+
+    def tokens(self, conversation_id):
+        """Return the conversation's token total (0 if unknown)"""
+        raise NotImplementedError
+
+
+class SQLiteBackend(ConversationBackend):
+    """Store conversations in a SQLite database shared by all workers on the instance
+
+    The database file must be on local disk; SQLite locking is not reliable on
+    network file systems such as the App Service ``/home`` share.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id TEXT PRIMARY KEY,
+                    messages TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    total_tokens INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(conversations)')]
+            if 'total_tokens' not in columns:
+                conn.execute('ALTER TABLE conversations ADD COLUMN total_tokens INTEGER NOT NULL DEFAULT 0')
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode, so that save() can manage its own transaction
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # WAL relies on shared memory, so the database must be on a local disk
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, conversation_id, max_age=None):
+        row = self._connect().execute(
+            'SELECT messages, version, updated_at FROM conversations WHERE id = ?',
+            (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if max_age is not None and now - row[2] > max_age:
+            self.delete(conversation_id)
+            return None
+        with self._connect() as conn:
+            conn.execute('UPDATE conversations SET updated_at = ? WHERE id = ?', (now, conversation_id))
+        return json.loads(row[0]), row[1]
+
+    def version(self, conversation_id):
+        row = self._connect().execute(
+            'SELECT version FROM conversations WHERE id = ?', (conversation_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, conversation_id, messages, expected_version):
+        conn = self._connect()
+        # Take the write lock up front so the version check and the write are atomic
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if expected_version == 0:
+                # The row may already exist without messages when tokens were counted first
+                cursor = conn.execute(
+                    'INSERT INTO conversations (id, messages, version, updated_at) VALUES (?, ?, 1, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET messages = excluded.messages, version = 1, '
+                    'updated_at = excluded.updated_at WHERE conversations.version = 0',
+                    (conversation_id, json.dumps(messages), time.time())
+                )
+            else:
+                cursor = conn.execute(
+                    'UPDATE conversations SET messages = ?, version = version + 1, updated_at = ? '
+                    'WHERE id = ? AND version = ?',
+                    (json.dumps(messages), time.time(), conversation_id, expected_version)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, conversation_id):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+
+    def purge(self, max_age):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM conversations WHERE updated_at < ?', (time.time() - max_age,))
+
+    def add_tokens(self, conversation_id, tokens):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO conversations (id, messages, version, updated_at, total_tokens) VALUES (?, '[]', 0, ?, ?) "
+                'ON CONFLICT(id) DO UPDATE SET total_tokens = total_tokens + excluded.total_tokens, '
+                'updated_at = excluded.updated_at',
+                (conversation_id, time.time(), tokens)
+            )
+
+    def tokens(self, conversation_id):
+        row = self._connect().execute(
+            'SELECT total_tokens FROM conversations WHERE id = ?', (conversation_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class _Entry:
+    __slots__ = ('messages', 'version', 'size', 'accessed_at', 'total_tokens')
+
+    def __init__(self, messages, version):
+        self.messages = messages
+        self.version = version
+        self.total_tokens = 0
+        self.size = estimate_size(messages)
+        self.accessed_at = time.time()
+
+
+class ConversationStore:
+    """In-memory conversation store with LRU/TTL eviction and an optional persistent backend"""
+
+    def __init__(self, max_conversations=1000, ttl_seconds=3600, max_bytes=50 * 1024 * 1024, backend=None,
+                 max_history_tokens=None):
+        self.max_conversations = max_conversations
+        self.max_history_tokens = max_history_tokens
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._purged_at = time.time()
+
+    def get(self, conversation_id):
+        """Return a copy of the conversation's messages (empty if unknown or expired)"""
+        with self._lock:
+            entry = self._get_entry(conversation_id)
+            return list(entry.messages) if entry else []
+
+    def append(self, conversation_id, *messages):
+        """Append messages to a conversation and persist them
+
+        With a backend, the write only succeeds against the version we read; if
+        another worker wrote in between, the conversation is reloaded and retried.
+        """
+        with self._lock:
+            for _ in range(MAX_SAVE_ATTEMPTS):
+                entry = self._get_entry(conversation_id)
+                if entry is None:
+                    entry = _Entry([], 0)
+                else:
+                    self._remove(conversation_id)
+                updated = compact_history(entry.messages + list(messages), self.max_history_tokens)
+                if self.backend and not self.backend.save(conversation_id, updated, entry.version):
+                    continue
+                entry.messages = updated
+                entry.version += 1
+                entry.size = estimate_size(entry.messages)
+                self._insert(conversation_id, entry)
+                self._evict()
+                self._purge_backend()
+                return
+            raise ConversationConflict(f"Conversation {conversation_id} kept changing while saving")
+
+    def add_tokens(self, conversation_id, tokens):
+        """Count tokens billed for a conversation, shared with other workers through the backend"""
+        with self._lock:
+            if self.backend:
+                self.backend.add_tokens(conversation_id, tokens)
+                return
+            entry = self._get_entry(conversation_id)
+            if entry is None:
+                entry = _Entry([], 0)
+                self._insert(conversation_id, entry)
+                self._evict()
+            entry.total_tokens += tokens
+
+    def tokens_used(self, conversation_id):
+        """Total tokens billed for a conversation so far"""
+        with self._lock:
+            if self.backend:
+                return self.backend.tokens(conversation_id)
+            entry = self._get_entry(conversation_id)
+            return entry.total_tokens if entry else 0
+
+    def clear(self, conversation_id):
+        """Forget a conversation"""
+        with self._lock:
+            self._remove(conversation_id)
+            if self.backend:
+                self.backend.delete(conversation_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._entries),
+                'memory_bytes': self._bytes,
+                'max_conversations': self.max_conversations,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'max_history_tokens': self.max_history_tokens,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'backend': type(self.backend).__name__ if self.backend else None
+            }
+
+    def _get_entry(self, conversation_id):
+        entry = self._entries.get(conversation_id)
+        now = time.time()
+
+        # Only the in-memory copy expires here; the backend decides from its own
+        # timestamps, since other workers may have kept the conversation active
+        if entry is not None and now - entry.accessed_at > self.ttl_seconds:
+            self._remove(conversation_id)
+            entry = None
+
+        # Another worker may have written the conversation since we cached it
+        if entry is not None and self.backend and self.backend.version(conversation_id) != entry.version:
+            self._remove(conversation_id)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            loaded = self.backend.load(conversation_id, self.ttl_seconds) if self.backend else None
+            if loaded is None:
+                return None
+            entry = _Entry(*loaded)
+            self._insert(conversation_id, entry)
+            self._evict()
+        else:
+            self.hits += 1
+            self._entries.move_to_end(conversation_id)
+
+        entry.accessed_at = now
+        return entry
+
+    def _insert(self, conversation_id, entry):
+        self._entries[conversation_id] = entry
+        self._bytes += entry.size
+
+    def _remove(self, conversation_id):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        """Drop expired conversations, then least recently used ones until within budget"""
+        now = time.time()
+        while self._entries:
+            oldest_id, oldest = next(iter(self._entries.items()))
+            expired = now - oldest.accessed_at > self.ttl_seconds
+            over_budget = len(self._entries) > self.max_conversations or self._bytes > self.max_bytes
+            # Always keep the most recently used conversation, even if it alone exceeds the budget
+            if not (expired or (over_budget and len(self._entries) > 1)):
+                break
+            # Evicted conversations stay in the backend, which expires them by itself
+            self._remove(oldest_id)
+            self.evictions += 1
+
+    def _purge_backend(self):
+        now = time.time()
+        if self.backend and now - self._purged_at > PURGE_INTERVAL_SECONDS:
+            self._purged_at = now
+            self.backend.purge(self.ttl_seconds)
+
+
+def create_store_from_env(max_history_tokens=None):
+    """Build a ConversationStore configured from environment variables
+
+    ``max_history_tokens`` is the default for CONVERSATION_STORE_MAX_HISTORY_TOKENS.
+    """
+    path = os.environ.get('CONVERSATION_STORE_PATH')
+    max_history_tokens = os.environ.get('CONVERSATION_STORE_MAX_HISTORY_TOKENS', max_history_tokens)
+    return ConversationStore(
+        max_conversations=int(os.environ.get('CONVERSATION_STORE_MAX_CONVERSATIONS', 1000)),
+        ttl_seconds=int(os.environ.get('CONVERSATION_STORE_TTL_SECONDS', 3600)),
+        max_bytes=int(os.environ.get('CONVERSATION_STORE_MAX_BYTES', 50 * 1024 * 1024)),
+        backend=SQLiteBackend(path) if path else None,
+        max_history_tokens=int(max_history_tokens) if max_history_tokens else None
+    )
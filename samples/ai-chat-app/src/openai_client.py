@@ -0,0 +1,350 @@
+"""Rate-limit aware Azure OpenAI client layer for the AI Chat App.
+
+Wraps ``openai.ChatCompletion`` with:
+- a shared HTTP connection pool,
+- retries with exponential backoff and jitter that honor ``Retry-After``,
+- token buckets for requests and tokens per minute that queue requests
+  instead of failing them,
+- a cap on concurrent upstream calls.
+
+``achat_completion`` is the asyncio equivalent for the ASGI app; it shares the
+buckets and statistics but pools connections in its own aiohttp session.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import aiohttp
+import openai
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class QueueTimeout(openai.error.RateLimitError):
+    """Raised when a request waited longer than allowed for rate limit capacity"""
+
+
+def is_retryable(error):
+    """Whether an OpenAI error is worth retrying (throttling, server errors, connection problems)"""
+    if isinstance(error, QueueTimeout):
+        return False
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+
+def retry_after_seconds(error):
+    """Read the server's requested delay from Retry-After / retry-after-ms, if any"""
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('Retry-After'):
+            return float(headers['Retry-After'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class SharedSession(requests.Session):
+    """A requests session shared by every thread that the openai library cannot close
+
+    openai 0.28 closes each thread's session every few minutes
+    (``MAX_SESSION_LIFETIME_SECS``) and then asks for a new one, which is this
+    same session; letting that close go through would drop every pooled
+    connection. Use ``shutdown()`` to really close it.
+    """
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate_per_minute``
+
+    Callers reserve capacity up front and are told how long to wait for it, so
+    requests are served in arrival order and the bucket may go into debt.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount, max_wait=None):
+        """Reserve ``amount`` tokens and return the seconds to wait before using them
+
+        Returns None without reserving anything if the wait would exceed ``max_wait``.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            amount = min(amount, self.capacity)
+            wait = max(0.0, (amount - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= amount
+            return wait
+
+    def refund(self, amount):
+        """Return unused capacity, e.g. when a request used fewer tokens than estimated"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.updated
+            return min(self.capacity, self.tokens + elapsed * self.rate)
+
+
+class OpenAIClient:
+    """Chat completion client with pooling, retries, rate limiting and concurrency control"""
+
+    def __init__(self, api_base, api_key, api_version, deployment,
+                 requests_per_minute=None, tokens_per_minute=None, max_concurrency=16,
+                 max_retries=5, backoff_base=0.5, backoff_max=30.0, max_queue_seconds=60.0,
+                 request_timeout=60.0):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.api_version = api_version
+        self.deployment = deployment
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_queue_seconds = max_queue_seconds
+        self.request_timeout = request_timeout
+        self.max_concurrency = max_concurrency
+
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._concurrency = threading.BoundedSemaphore(max_concurrency)
+
+        # One pooled session shared by every thread instead of one per thread
+        self.session = SharedSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        openai.requestssession = self.session
+
+        # Created on first use, inside the event loop that runs the async calls
+        self._async_concurrency = None
+        self._async_session = None
+
+        self._stats_lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0
+        self.queued_seconds = 0.0
+
+    def chat_completion(self, messages, estimated_tokens=0, stream=False, timings=None, **params):
+        """Create a chat completion, waiting for rate limit capacity and retrying transient errors
+
+        ``estimated_tokens`` (prompt plus maximum completion) is charged against the
+        tokens-per-minute budget; for non-streamed calls the unused part is refunded.
+        If ``timings`` is a dict, ``sent_at`` is set to the ``time.perf_counter()`` at
+        which the last attempt was sent, after queueing and retry backoff.
+        """
+        self._acquire_capacity(estimated_tokens)
+        self._concurrency.acquire()
+        try:
+            response = self._create_with_retries(messages, stream, params, timings)
+        except Exception:
+            self._concurrency.release()
+            raise
+
+        if stream:
+            # Hold the concurrency slot until the stream has been consumed
+            return self._release_after(response)
+
+        self._concurrency.release()
+        if self.token_bucket and estimated_tokens and getattr(response, 'usage', None):
+            self.token_bucket.refund(max(0, estimated_tokens - response.usage.total_tokens))
+        return response
+
+    async def achat_completion(self, messages, estimated_tokens=0, stream=False, timings=None, **params):
+        """Async version of chat_completion: waits, retries and streams without blocking the event loop"""
+        if self._async_concurrency is None:
+            self._async_concurrency = asyncio.Semaphore(self.max_concurrency)
+
+        wait = self._reserve_capacity(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self._async_concurrency.acquire()
+        try:
+            response = await self._acreate_with_retries(messages, stream, params, timings)
+        except BaseException:
+            self._async_concurrency.release()
+            raise
+
+        if stream:
+            # Hold the concurrency slot until the stream has been consumed
+            return self._arelease_after(response)
+
+        self._async_concurrency.release()
+        if self.token_bucket and estimated_tokens and getattr(response, 'usage', None):
+            self.token_bucket.refund(max(0, estimated_tokens - response.usage.total_tokens))
+        return response
+
+    async def aclose(self):
+        """Close the aiohttp session used by achat_completion"""
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {
+                'max_concurrency': self.max_concurrency,
+                'retries': self.retries,
+                'throttled_responses': self.throttled,
+                'queued_seconds': round(self.queued_seconds, 3)
+            }
+        if self.request_bucket:
+            stats['requests_per_minute'] = self.request_bucket.capacity
+            stats['requests_available'] = int(self.request_bucket.available())
+        if self.token_bucket:
+            stats['tokens_per_minute'] = self.token_bucket.capacity
+            stats['tokens_available'] = int(self.token_bucket.available())
+        return stats
+
+    def _acquire_capacity(self, estimated_tokens):
+        """Queue until both buckets have capacity, or raise QueueTimeout"""
+        wait = self._reserve_capacity(estimated_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve_capacity(self, estimated_tokens):
+        """Reserve capacity on both buckets and return the seconds to wait for it, or raise QueueTimeout"""
+        reservations = []
+        wait = 0.0
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, estimated_tokens)):
+            if bucket is None or amount <= 0:
+                continue
+            bucket_wait = bucket.reserve(amount, self.max_queue_seconds)
+            if bucket_wait is None:
+                for reserved_bucket, reserved_amount in reservations:
+                    reserved_bucket.refund(reserved_amount)
+                raise QueueTimeout(f"Rate limit queue wait exceeded {self.max_queue_seconds}s")
+            reservations.append((bucket, amount))
+            wait = max(wait, bucket_wait)
+
+        if wait > 0:
+            with self._stats_lock:
+                self.queued_seconds += wait
+        return wait
+
+    def _create_with_retries(self, messages, stream, params, timings=None):
+        attempt = 0
+        while True:
+            if timings is not None:
+                timings['sent_at'] = time.perf_counter()
+            try:
+                return openai.ChatCompletion.create(
+                    engine=self.deployment,
+                    messages=messages,
+                    stream=stream,
+                    api_type='azure',
+                    api_base=self.api_base,
+                    api_key=self.api_key,
+                    api_version=self.api_version,
+                    request_timeout=self.request_timeout,
+                    **params
+                )
+            except openai.error.OpenAIError as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                time.sleep(delay)
+
+    async def _acreate_with_retries(self, messages, stream, params, timings=None):
+        if self._async_session is None:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency)
+            )
+        # openai reads the session from a context variable, so set it in the calling task
+        openai.aiosession.set(self._async_session)
+
+        attempt = 0
+        while True:
+            if timings is not None:
+                timings['sent_at'] = time.perf_counter()
+            try:
+                return await openai.ChatCompletion.acreate(
+                    engine=self.deployment,
+                    messages=messages,
+                    stream=stream,
+                    api_type='azure',
+                    api_base=self.api_base,
+                    api_key=self.api_key,
+                    api_version=self.api_version,
+                    request_timeout=self.request_timeout,
+                    **params
+                )
+            except openai.error.OpenAIError as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, error):
+        """Exponential backoff with full jitter, or the server's Retry-After plus a little jitter"""
+        with self._stats_lock:
+            self.retries += 1
+            if isinstance(error, openai.error.RateLimitError):
+                self.throttled += 1
+
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _release_after(self, chunks):
+        try:
+            yield from chunks
+        finally:
+            self._concurrency.release()
+
+    async def _arelease_after(self, chunks):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self._async_concurrency.release()
+
+
+def create_client_from_env():
+    """Build an OpenAIClient configured from environment variables"""
+    # The quotas belong to the deployment, but each process keeps its own buckets,
+    # so split them between all processes (workers on every instance) sharing it
+    processes = max(1, int(os.environ.get("AZURE_OPENAI_RATE_LIMIT_PROCESSES", 1)))
+
+    def optional_int(name):
+        value = os.environ.get(name)
+        return max(1, int(value) // processes) if value else None
+
+    return OpenAIClient(
+        api_base=os.environ.get("AZURE_OPENAI_ENDPOINT", ""),
+        api_key=os.environ.get("AZURE_OPENAI_API_KEY", ""),
+        api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-06-01"),
+        deployment=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo"),
+        requests_per_minute=optional_int("AZURE_OPENAI_REQUESTS_PER_MINUTE"),
+        tokens_per_minute=optional_int("AZURE_OPENAI_TOKENS_PER_MINUTE"),
+        max_concurrency=int(os.environ.get("AZURE_OPENAI_MAX_CONCURRENCY", 16)),
+        max_retries=int(os.environ.get("AZURE_OPENAI_MAX_RETRIES", 5)),
+        max_queue_seconds=float(os.environ.get("AZURE_OPENAI_MAX_QUEUE_SECONDS", 60))
+    )
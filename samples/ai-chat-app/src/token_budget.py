@@ -0,0 +1,90 @@
+"""Token counting and token-budget based history selection for the AI Chat App.
+
+Stored messages carry their token count in a ``tokens`` field, so each message
+is tokenized once when it is added to the conversation and never again.
+"""
+import logging
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Fixed per-message overhead of the chat format (role and separators), and the
+# tokens that prime the assistant reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Marks a stored message as a summary of the first ``summary_of`` conversation messages
+SUMMARY_KEY = 'summary_of'
+
+_encodings = {}
+
+
+def get_encoding(model_name):
+    """Return the tokenizer for a model, or None if it can't be loaded"""
+    if model_name in _encodings:
+        return _encodings[model_name]
+
+    # Azure model names drop the dot from the version (gpt-35-turbo)
+    tiktoken_name = model_name.replace('gpt-35', 'gpt-3.5')
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(tiktoken_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.warning(f"Tokenizer for {model_name} unavailable, estimating token counts: {str(e)}")
+        encoding = None
+
+    _encodings[model_name] = encoding
+    return encoding
+
+
+def count_tokens(text, model_name):
+    """Count the tokens in a piece of text"""
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        # Roughly four characters per token for English text
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text))
+
+
+def with_token_count(message, model_name):
+    """Return the message with its token count cached in the ``tokens`` field"""
+    if 'tokens' in message:
+        return message
+    return dict(message, tokens=count_tokens(message['content'], model_name) + TOKENS_PER_MESSAGE)
+
+
+def message_tokens(message, model_name):
+    return with_token_count(message, model_name)['tokens']
+
+
+def split_history(history):
+    """Split stored history into (latest summary or None, conversation messages)"""
+    summary = None
+    messages = []
+    for message in history:
+        if SUMMARY_KEY in message:
+            summary = message
+        else:
+            messages.append(message)
+    return summary, messages
+
+
+def select_window(messages, budget, model_name):
+    """Return the longest suffix of messages that fits the token budget (at least one message)"""
+    used = 0
+    start = len(messages)
+    while start > 0:
+        tokens = message_tokens(messages[start - 1], model_name)
+        if used + tokens > budget and start < len(messages):
+            break
+        used += tokens
+        start -= 1
+    return start, used
+
+
+def strip_metadata(message):
+    """Reduce a stored message to the fields the OpenAI API accepts"""
+    return {'role': message['role'], 'content': message['content']}
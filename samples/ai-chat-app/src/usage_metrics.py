@@ -0,0 +1,189 @@
+"""In-process token usage and latency accounting for the AI Chat App.
+
+Keeps rolling windows of prompt tokens, completion tokens, upstream latency and
+time-to-first-token per deployment, plus running totals per conversation.
+Memory is bounded: series are aggregated into fixed time buckets with a capped
+sample reservoir for percentiles, and conversations are kept in an LRU.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+METRIC_NAMES = ('prompt_tokens', 'completion_tokens', 'upstream_latency_ms', 'time_to_first_token_ms', 'queue_ms')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class RollingSeries:
+    """Counts and sums per time bucket over the longest window, plus recent samples for percentiles"""
+
+    def __init__(self, max_window_seconds, bucket_seconds=10, max_samples=1000):
+        self.max_window_seconds = max_window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.buckets = deque()  # [bucket_start, count, total, maximum]
+        self.samples = deque(maxlen=max_samples)  # (timestamp, value)
+
+    def record(self, value, now):
+        bucket_start = now - now % self.bucket_seconds
+        if self.buckets and self.buckets[-1][0] == bucket_start:
+            bucket = self.buckets[-1]
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = max(bucket[3], value)
+        else:
+            self.buckets.append([bucket_start, 1, value, value])
+        self.samples.append((now, value))
+        self._trim(now)
+
+    def summary(self, window_seconds, now):
+        self._trim(now)
+        since = now - window_seconds
+        count = total = 0
+        maximum = None
+        for bucket_start, bucket_count, bucket_total, bucket_max in self.buckets:
+            if bucket_start + self.bucket_seconds > since:
+                count += bucket_count
+                total += bucket_total
+                maximum = bucket_max if maximum is None else max(maximum, bucket_max)
+        values = sorted(value for timestamp, value in self.samples if timestamp > since)
+        return {
+            'count': count,
+            'sum': round(total, 3),
+            'avg': round(total / count, 3) if count else None,
+            'max': maximum,
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99)
+        }
+
+    def _trim(self, now):
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= now - self.max_window_seconds:
+            self.buckets.popleft()
+
+
+class UsageMetrics:
+    """Aggregates completion usage by deployment (rolling windows) and by conversation (totals)"""
+
+    def __init__(self, windows=(60, 300, 3600), max_conversations=10000):
+        self.windows = tuple(sorted(windows))
+        self.max_conversations = max_conversations
+        self._deployments = {}
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def record_completion(self, deployment, conversation_id, prompt_tokens, completion_tokens,
+                          latency_ms, time_to_first_token_ms=None, queue_ms=None):
+        """Record an upstream completion call; ``queue_ms`` is time spent waiting locally before it was sent"""
+        now = time.time()
+        latency_ms = round(latency_ms, 3)
+        if time_to_first_token_ms is not None:
+            time_to_first_token_ms = round(time_to_first_token_ms, 3)
+        if queue_ms is not None:
+            queue_ms = round(queue_ms, 3)
+        with self._lock:
+            deployment_metrics = self._deployment(deployment)
+            deployment_metrics['requests'] += 1
+            series = deployment_metrics['series']
+            series['prompt_tokens'].record(prompt_tokens, now)
+            series['completion_tokens'].record(completion_tokens, now)
+            series['upstream_latency_ms'].record(latency_ms, now)
+            if time_to_first_token_ms is not None:
+                series['time_to_first_token_ms'].record(time_to_first_token_ms, now)
+            if queue_ms is not None:
+                series['queue_ms'].record(queue_ms, now)
+
+            if conversation_id:
+                conversation = self._conversation(conversation_id, now)
+                conversation['requests'] += 1
+                conversation['prompt_tokens'] += prompt_tokens
+                conversation['completion_tokens'] += completion_tokens
+                conversation['total_tokens'] += prompt_tokens + completion_tokens
+                conversation['upstream_latency_ms'] = round(conversation['upstream_latency_ms'] + latency_ms, 3)
+
+    def record_cache_hit(self, deployment):
+        with self._lock:
+            self._deployment(deployment)['cache_hits'] += 1
+
+    def record_error(self, deployment):
+        with self._lock:
+            self._deployment(deployment)['errors'] += 1
+
+    def conversation_summary(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            return dict(conversation) if conversation else None
+
+    def summary(self, windows=None, top_conversations=10):
+        """Snapshot of all metrics, with the conversations that used the most tokens"""
+        now = time.time()
+        windows = windows or self.windows
+        with self._lock:
+            deployments = {}
+            for name, deployment_metrics in self._deployments.items():
+                deployments[name] = {
+                    'requests': deployment_metrics['requests'],
+                    'cache_hits': deployment_metrics['cache_hits'],
+                    'errors': deployment_metrics['errors'],
+                    'windows': {
+                        f'{window}s': {
+                            metric: series.summary(window, now)
+                            for metric, series in deployment_metrics['series'].items()
+                        }
+                        for window in windows
+                    }
+                }
+            top = sorted(self._conversations.items(), key=lambda item: item[1]['total_tokens'], reverse=True)
+            return {
+                'uptime_seconds': round(now - self.started_at),
+                'deployments': deployments,
+                'conversations': {
+                    'tracked': len(self._conversations),
+                    'max_tracked': self.max_conversations,
+                    'top_by_tokens': [dict(c, conversation_id=cid) for cid, c in top[:top_conversations]]
+                }
+            }
+
+    def _deployment(self, deployment):
+        if deployment not in self._deployments:
+            self._deployments[deployment] = {
+                'requests': 0,
+                'cache_hits': 0,
+                'errors': 0,
+                'series': {name: RollingSeries(self.windows[-1]) for name in METRIC_NAMES}
+            }
+        return self._deployments[deployment]
+
+    def _conversation(self, conversation_id, now):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = self._conversations[conversation_id] = {
+                'requests': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'total_tokens': 0,
+                'upstream_latency_ms': 0.0,
+                'first_seen': now
+            }
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        conversation['last_seen'] = now
+        return conversation
+
+
+def create_metrics_from_env():
+    """Build UsageMetrics configured from environment variables"""
+    windows = os.environ.get('METRICS_WINDOWS_SECONDS', '60,300,3600')
+    return UsageMetrics(
+        windows=[int(w) for w in windows.split(',') if w.strip()],
+        max_conversations=int(os.environ.get('METRICS_MAX_CONVERSATIONS', 10000))
+    )
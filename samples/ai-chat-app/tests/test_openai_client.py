@@ -0,0 +1,139 @@
+"""Tests for the OpenAI client layer against the local fake Azure OpenAI server."""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import openai
+import pytest
+
+SAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SAMPLE_DIR, 'src'))
+sys.path.insert(0, os.path.join(SAMPLE_DIR, 'dev'))
+
+from fake_openai_server import FakeOpenAIState, make_handler  # noqa: E402
+from openai_client import OpenAIClient, QueueTimeout  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+@pytest.fixture
+def fake_server():
+    """Start fake servers on free ports; yields a factory returning (api_base, state)"""
+    servers = []
+
+    def start(rpm=0, window=60.0, fail_rate=0.0, fail_first=0, latency=0.0, token_delay=0.0):
+        args = argparse.Namespace(rpm=rpm, window=window, fail_rate=fail_rate, fail_first=fail_first,
+                                  latency=latency, token_delay=token_delay, quiet=True)
+        state = FakeOpenAIState(args)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}/', state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(api_base, **options):
+    options.setdefault('backoff_base', 0.01)
+    return OpenAIClient(api_base, 'fake-key', '2024-06-01', 'gpt-35-turbo', **options)
+
+
+def test_throttled_requests_wait_for_retry_after(fake_server):
+    api_base, state = fake_server(rpm=2, window=1.0)
+    client = make_client(api_base)
+
+    started = time.monotonic()
+    for _ in range(4):
+        response = client.chat_completion(MESSAGES)
+        assert response.choices[0].message.content
+    elapsed = time.monotonic() - started
+
+    server_stats = state.stats()
+    client_stats = client.stats()
+    assert server_stats['throttled'] >= 1
+    assert client_stats['throttled_responses'] == server_stats['throttled']
+    # Waiting as long as Retry-After asks makes every retry succeed at the first attempt
+    assert server_stats['throttled'] == client_stats['retries'] == 1
+    assert server_stats['requests'] == 4 + server_stats['throttled']
+    assert elapsed >= 0.9
+
+
+def test_server_errors_are_retried(fake_server):
+    api_base, state = fake_server(fail_first=2)
+    client = make_client(api_base)
+
+    response = client.chat_completion(MESSAGES)
+
+    assert response.choices[0].message.content
+    assert state.stats()['failed'] == 2
+    assert client.stats()['retries'] == 2
+
+
+def test_server_errors_fail_after_max_retries(fake_server):
+    api_base, state = fake_server(fail_first=3)
+    client = make_client(api_base, max_retries=1)
+
+    with pytest.raises(openai.error.OpenAIError):
+        client.chat_completion(MESSAGES)
+    assert state.stats()['requests'] == 2
+
+
+def test_token_bucket_queues_requests(fake_server):
+    api_base, state = fake_server()
+    # 2 tokens per second; streamed calls keep their whole reservation
+    client = make_client(api_base, tokens_per_minute=120)
+
+    started = time.monotonic()
+    for estimated_tokens in (120, 2):
+        chunks = list(client.chat_completion(MESSAGES, estimated_tokens=estimated_tokens, stream=True))
+        assert chunks
+    elapsed = time.monotonic() - started
+
+    assert elapsed >= 0.9
+    assert client.stats()['queued_seconds'] >= 0.9
+    assert state.stats()['throttled'] == 0
+
+
+def test_token_bucket_rejects_waits_beyond_max_queue(fake_server):
+    api_base, state = fake_server()
+    client = make_client(api_base, tokens_per_minute=120, max_queue_seconds=0.5)
+
+    list(client.chat_completion(MESSAGES, estimated_tokens=120, stream=True))
+    with pytest.raises(QueueTimeout):
+        client.chat_completion(MESSAGES, estimated_tokens=120)
+    assert state.stats()['requests'] == 1
+
+
+def test_concurrency_cap(fake_server):
+    api_base, state = fake_server(latency=0.2)
+    client = make_client(api_base, max_concurrency=3)
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        responses = list(pool.map(lambda _: client.chat_completion(MESSAGES), range(12)))
+
+    assert len(responses) == 12
+    assert 1 < state.stats()['max_concurrent'] <= 3
+
+
+def test_async_concurrency_cap(fake_server):
+    api_base, state = fake_server(latency=0.2)
+    client = make_client(api_base, max_concurrency=3)
+
+    async def run():
+        try:
+            return await asyncio.gather(*(client.achat_completion(MESSAGES) for _ in range(12)))
+        finally:
+            await client.aclose()
+
+    responses = asyncio.run(run())
+
+    assert len(responses) == 12
+    assert 1 < state.stats()['max_concurrent'] <= 3
@@ -0,0 +1,304 @@
+"""Load-test and regression benchmark for the FastAPI web app sample.
+
+Runs the CRUD endpoints of ``src/main.py`` at increasing dataset sizes and
+concurrency levels, either in-process through an ASGI transport or against a
+locally started uvicorn server, and compares the results with a stored
+baseline. The run exits with a non-zero status when a scenario regresses.
+
+Usage:
+    python benchmarks/bench.py                     # both transports, compare with baseline
+    python benchmarks/bench.py --transport asgi    # in-process only
+    python benchmarks/bench.py --update-baseline   # record the current results
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+SCENARIOS = ["list", "get", "create", "update", "delete"]
+TRANSPORTS = ["asgi", "uvicorn"]
+
+sys.path.insert(0, SRC_DIR)
+
+
+def seed_items(count: int):
+    """Replace the in-memory items database with ``count`` generated items."""
+    import main
+
+    now = datetime.now()
+    main.items_db[:] = [
+        main.Item(
+            id=i,
+            name=f"Bench Item {i}",
+            description=f"Generated item number {i}",
+            price=round(1 + (i % 1000) * 0.25, 2),
+            created_at=now,
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def quiet_logging():
+    """Per-request logging from the app and httpx would dominate the measurements."""
+    import main  # noqa: F401 - main configures the root logger on import
+
+    for name in ("main", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def build_request(scenario: str, index: int, dataset_size: int):
+    """Return (method, url, json body) for the ``index``-th request of a scenario."""
+    payload = {"name": f"Bench Update {index}", "description": "Benchmark payload", "price": 9.99}
+    item_id = (index % dataset_size) + 1
+    if scenario == "list":
+        return "GET", "/items", None
+    if scenario == "get":
+        return "GET", f"/items/{item_id}", None
+    if scenario == "create":
+        return "POST", "/items", payload
+    if scenario == "update":
+        return "PUT", f"/items/{item_id}", payload
+    if scenario == "delete":
+        # Every delete targets a distinct, still existing item
+        return "DELETE", f"/items/{index + 1}", None
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: str, dataset_size: int,
+                       concurrency: int, total_requests: int) -> Dict[str, float]:
+    """Fire ``total_requests`` requests with ``concurrency`` workers and collect stats."""
+    if scenario == "delete":
+        total_requests = min(total_requests, dataset_size)
+
+    counter = itertools.count()
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            index = next(counter)
+            if index >= total_requests:
+                return
+            method, url, body = build_request(scenario, index, dataset_size)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "throughput_rps": round(total_requests / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p90_ms": round(percentile(latencies, 90), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(dataset_size: int) -> Tuple[subprocess.Popen, str]:
+    """Start a seeded uvicorn server in a subprocess and wait until it is healthy."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--items", str(dataset_size)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("uvicorn exited before becoming healthy")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("uvicorn did not become healthy within 30 seconds")
+
+
+def stop_uvicorn(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def bench_transport(transport: str, args) -> Dict[str, Dict[str, float]]:
+    """Run every scenario/size/concurrency combination against one transport."""
+    import main
+
+    results = {}
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    for scenario, size, concurrency in itertools.product(args.scenarios, args.sizes, args.concurrency):
+        key = f"{transport}/{scenario}/items={size}/concurrency={concurrency}"
+        # Reseed before each scenario so create/delete runs don't leak into the next one
+        if transport == "asgi":
+            seed_items(size)
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+            process = None
+        else:
+            process, base_url = start_uvicorn(size)
+            client = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60)
+        try:
+            async with client:
+                # Open the connection pool up front so connection setup isn't timed
+                await asyncio.gather(*(client.get("/health") for _ in range(concurrency)))
+                results[key] = await run_scenario(client, scenario, size, concurrency, args.requests)
+        finally:
+            if process is not None:
+                stop_uvicorn(process)
+        stats = results[key]
+        print(f"{key:<55} {stats['throughput_rps']:>10.1f} req/s  "
+              f"p50 {stats['p50_ms']:>8.2f}ms  p90 {stats['p90_ms']:>8.2f}ms  "
+              f"p99 {stats['p99_ms']:>8.2f}ms  errors {stats['errors']}")
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                          tolerance: float, latency_slack_ms: float) -> List[str]:
+    """Return a human readable description of every regressed scenario."""
+    regressions = []
+    for key, stats in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        # Percentiles over a different number of requests are not comparable
+        if reference.get("requests") != stats["requests"]:
+            print(f"Skipping {key}: {stats['requests']} requests, baseline has {reference.get('requests')}")
+            continue
+        if stats["errors"] > reference.get("errors", 0):
+            regressions.append(f"{key}: errors {stats['errors']} > baseline {reference.get('errors', 0)}")
+        if stats["throughput_rps"] < reference["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {stats['throughput_rps']} req/s "
+                               f"< baseline {reference['throughput_rps']} req/s")
+        # Sub-millisecond latencies are noisy, so require an absolute slowdown as well
+        if stats["p99_ms"] > max(reference["p99_ms"] * (1 + tolerance), reference["p99_ms"] + latency_slack_ms):
+            regressions.append(f"{key}: p99 {stats['p99_ms']}ms > baseline {reference['p99_ms']}ms")
+    return regressions
+
+
+def serve(port: int, items: int):
+    """Entry point for the uvicorn subprocess: seed the database and serve the app."""
+    import uvicorn
+    import main
+
+    seed_items(items)
+    quiet_logging()
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the FastAPI web app sample")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--items", type=int, required=True)
+
+    parser.add_argument("--transport", choices=TRANSPORTS, action="append",
+                        help="Transport to benchmark (repeatable, default: all)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 10000],
+                        help="Number of items in the database for each run")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 10, 50],
+                        help="Number of concurrent clients for each run")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per run")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Path to the baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed relative slowdown before a run counts as a regression")
+    parser.add_argument("--latency-slack-ms", type=float, default=2.0,
+                        help="Absolute p99 increase (ms) tolerated on top of --tolerance")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Write the results to the baseline file instead of comparing")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.command == "serve":
+        serve(args.port, args.items)
+        return 0
+
+    quiet_logging()
+
+    results = {}
+    for transport in args.transport or TRANSPORTS:
+        results.update(asyncio.run(bench_transport(transport, args)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline found at {args.baseline}; run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.tolerance, args.latency_slack_ms)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        return 1
+
+    print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())